@@ -10,7 +10,13 @@
 #-------------------------------------------------------------------------------
 
 
+import argparse
+import array
+import ast
+import collections
 import configparser
+import difflib
+import heapq
 import os
 import os.path
 import queue
@@ -36,13 +42,164 @@ INSTRUCTIONS_8051 = ['acall', 'add', 'addc', 'ajmp', 'anl', 'cjne', 'clr', 'cpl'
                     'rl', 'rlc', 'rr', 'rrc', 'setb', 'sjmp', 'subb', 'swap',
                     'xch', 'xrl']
 
+
+def _opcodes_8051():
+    # (mnemonic, operands, length, flow) for every opcode, None for the reserved one;
+    # operands are literal or one of direct, bit, /bit, #data, #data16, rel, addr11 and addr16,
+    # and flow is None, 'jump', 'branch', 'call' or 'return'
+    sizes = {'direct': 1, 'bit': 1, '/bit': 1, '#data': 1, '#data16': 2, 'rel': 1, 'addr11': 1, 'addr16': 2}
+    table = [None] * 256
+
+    def add(opcode, mnemonic, *operands, flow=None):
+        table[opcode] = (mnemonic, operands, 1 + sum(sizes.get(operand, 0) for operand in operands), flow)
+
+    def add_registers(row, mnemonic, *operands, flow=None):
+        # columns 6 & 7 take @r0 & @r1 and columns 8 to f take r0 to r7 in place of the 'r' operand
+        for column, register in enumerate(['@r0', '@r1'] + ['r%d' % n for n in range(8)], 6):
+            add(row | column, mnemonic, *[register if operand == 'r' else operand for operand in operands], flow=flow)
+
+    for page in range(8):
+        add(page << 5 | 0x01, 'ajmp', 'addr11', flow='jump')
+        add(page << 5 | 0x11, 'acall', 'addr11', flow='call')
+    for row, mnemonic in ((0x20, 'add'), (0x30, 'addc'), (0x40, 'orl'), (0x50, 'anl'), (0x60, 'xrl'), (0x90, 'subb')):
+        add(row | 0x04, mnemonic, 'a', '#data')
+        add(row | 0x05, mnemonic, 'a', 'direct')
+        add_registers(row, mnemonic, 'a', 'r')
+    for row, mnemonic in ((0x40, 'orl'), (0x50, 'anl'), (0x60, 'xrl')):
+        add(row | 0x02, mnemonic, 'direct', 'a')
+        add(row | 0x03, mnemonic, 'direct', '#data')
+    for row, mnemonic in ((0x10, 'jbc'), (0x20, 'jb'), (0x30, 'jnb')):
+        add(row, mnemonic, 'bit', 'rel', flow='branch')
+    for row, mnemonic in ((0x40, 'jc'), (0x50, 'jnc'), (0x60, 'jz'), (0x70, 'jnz')):
+        add(row, mnemonic, 'rel', flow='branch')
+
+    add(0x00, 'nop')
+    add(0x02, 'ljmp', 'addr16', flow='jump')
+    add(0x03, 'rr', 'a')
+    add(0x04, 'inc', 'a')
+    add(0x05, 'inc', 'direct')
+    add_registers(0x00, 'inc', 'r')
+    add(0x12, 'lcall', 'addr16', flow='call')
+    add(0x13, 'rrc', 'a')
+    add(0x14, 'dec', 'a')
+    add(0x15, 'dec', 'direct')
+    add_registers(0x10, 'dec', 'r')
+    add(0x22, 'ret', flow='return')
+    add(0x23, 'rl', 'a')
+    add(0x32, 'reti', flow='return')
+    add(0x33, 'rlc', 'a')
+    add(0x72, 'orl', 'c', 'bit')
+    add(0x73, 'jmp', '@a+dptr', flow='return')
+    add(0x74, 'mov', 'a', '#data')
+    add(0x75, 'mov', 'direct', '#data')
+    add_registers(0x70, 'mov', 'r', '#data')
+    add(0x80, 'sjmp', 'rel', flow='jump')
+    add(0x82, 'anl', 'c', 'bit')
+    add(0x83, 'movc', 'a', '@a+pc')
+    add(0x84, 'div', 'ab')
+    add(0x85, 'mov', 'direct', 'direct')  # source byte comes first
+    add_registers(0x80, 'mov', 'direct', 'r')
+    add(0x90, 'mov', 'dptr', '#data16')
+    add(0x92, 'mov', 'bit', 'c')
+    add(0x93, 'movc', 'a', '@a+dptr')
+    add(0xa0, 'orl', 'c', '/bit')
+    add(0xa2, 'mov', 'c', 'bit')
+    add(0xa3, 'inc', 'dptr')
+    add(0xa4, 'mul', 'ab')
+    add_registers(0xa0, 'mov', 'r', 'direct')
+    add(0xb0, 'anl', 'c', '/bit')
+    add(0xb2, 'cpl', 'bit')
+    add(0xb3, 'cpl', 'c')
+    add(0xb4, 'cjne', 'a', '#data', 'rel', flow='branch')
+    add(0xb5, 'cjne', 'a', 'direct', 'rel', flow='branch')
+    add_registers(0xb0, 'cjne', 'r', '#data', 'rel', flow='branch')
+    add(0xc0, 'push', 'direct')
+    add(0xc2, 'clr', 'bit')
+    add(0xc3, 'clr', 'c')
+    add(0xc4, 'swap', 'a')
+    add(0xc5, 'xch', 'a', 'direct')
+    add_registers(0xc0, 'xch', 'a', 'r')
+    add(0xd0, 'pop', 'direct')
+    add(0xd2, 'setb', 'bit')
+    add(0xd3, 'setb', 'c')
+    add(0xd4, 'da', 'a')
+    add(0xd5, 'djnz', 'direct', 'rel', flow='branch')
+    add(0xd6, 'xchd', 'a', '@r0')
+    add(0xd7, 'xchd', 'a', '@r1')
+    for n in range(8):
+        add(0xd8 | n, 'djnz', 'r%d' % n, 'rel', flow='branch')
+    add(0xe0, 'movx', 'a', '@dptr')
+    add(0xe2, 'movx', 'a', '@r0')
+    add(0xe3, 'movx', 'a', '@r1')
+    add(0xe4, 'clr', 'a')
+    add(0xe5, 'mov', 'a', 'direct')
+    add_registers(0xe0, 'mov', 'a', 'r')
+    add(0xf0, 'movx', '@dptr', 'a')
+    add(0xf2, 'movx', '@r0', 'a')
+    add(0xf3, 'movx', '@r1', 'a')
+    add(0xf4, 'cpl', 'a')
+    add(0xf5, 'mov', 'direct', 'a')
+    add_registers(0xf0, 'mov', 'r', 'a')
+    return table
+
+# decoding table for the disassembler, indexed by opcode
+OPCODES_8051 = _opcodes_8051()
+
+# timer 0 interrupt stub assembled after the program to sample its pc for profiling;
+# each interrupt sends one byte of a (0xa5, pc high, pc low) sample, skipping the interrupt if the link is busy
+PROFILE_STUB = '''
+; ==== profiling stub added by the ide ====
+            .equ  prof_state, 0%(scratch)02xh
+            .equ  prof_high, 0%(scratch_high)02xh
+            .equ  prof_low, 0%(scratch_low)02xh
+            .org  0%(vector)04xh          ; timer 0 interrupt vector
+            ljmp  prof_isr
+            .org  0%(stub)04xh
+prof_init:  mov   prof_state, #0   ; start profiling here, then continue into the program
+            anl   tmod, #0f0h      ; timer 0 in 8-bit auto reload mode
+            orl   tmod, #02h
+            mov   th0, #0
+            setb  tr0
+            setb  et0
+            setb  ea
+            ljmp  0%(entry)04xh
+prof_isr:   push  acc
+            push  psw
+            mov   psw, #0          ; register bank 0 so r0 is at 00h
+            push  00h
+            jnb   ti, prof_done    ; link busy, drop this sample
+            clr   ti
+            mov   a, prof_state
+            jnz   prof_next
+            mov   r0, sp           ; interrupted pc is under the three registers saved
+            dec   r0
+            dec   r0
+            dec   r0
+            mov   prof_high, @r0
+            dec   r0
+            mov   prof_low, @r0
+            mov   sbuf, #0a5h      ; sync byte starts each sample
+            mov   prof_state, #1
+            sjmp  prof_done
+prof_next:  cjne  a, #1, prof_second
+            mov   sbuf, prof_high
+            mov   prof_state, #2
+            sjmp  prof_done
+prof_second: mov  sbuf, prof_low
+            mov   prof_state, #0
+prof_done:  pop   00h
+            pop   psw
+            pop   acc
+            reti
+'''
+
 # load relative path no matter what working directory IDE is launched from
 relative_path = lambda path: os.path.join(os.path.dirname(__file__), path)
 
 
 class MainWindow(QMainWindow):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, port_name=None):
         super().__init__(parent)
 
         # appearance
@@ -51,15 +208,25 @@ class MainWindow(QMainWindow):
         # configuration
         self.config = configparser.ConfigParser()
         self.config.read(relative_path('config.ini'))
+        self.port_name = port_name  # used instead of the configured ports for this session only
 
         # widgets
         self.terminal_widget = TerminalWidget(self, self)
         self.code_widget = CodeWidget(self, self)
+        self.hex_widget = HexWidget(self, self)
+        self.hex_widget.hide()
+        self.latency_widget = LatencyWidget(self.terminal_widget.latency, self)
+        self.latency_widget.hide()
+        self.disassembly_widget = DisassemblyWidget(self, self)
+        self.disassembly_widget.hide()
 
         # layout
         splitter = QSplitter(self)
         splitter.addWidget(self.terminal_widget)
+        splitter.addWidget(self.hex_widget)
+        splitter.addWidget(self.latency_widget)
         splitter.addWidget(self.code_widget)
+        splitter.addWidget(self.disassembly_widget)
         self.setCentralWidget(splitter)
 
         # toolbar
@@ -88,16 +255,26 @@ class MainToolbar(QToolBar):
         self._add_button('New', 'new.png', self.root.code_widget.new)
         self.addSeparator()
         self._add_button('Assemble and send', 'device.png', self.root.code_widget.send)
+        self._add_button('Profile', None, self.root.code_widget.profile)
         self.addSeparator()
         self._add_button('Reassemble', 'refresh.png', self.root.code_widget.assemble)
         self._add_button('Configure', 'config.png', self.root.configure)
+        self.addSeparator()
+        self._add_button('Binary capture', None, self.root.terminal_widget.toggle_capture)
+        self._add_button('Upload memory', None, self.root.terminal_widget.upload_memory)
+        self._add_button('Latency', None, self.root.latency_widget.toggle)
+        self._add_button('Run test script', None, self.root.terminal_widget.run_script)
+        self._add_button('Cancel transfer', None, self.root.terminal_widget.cancel_jobs)
 
     def _add_button(self, tooltip, icon, action, menu=None):
         # fixme: use QActions?
         # fixme: add shortcuts
         button = QToolButton(self)
         button.clicked.connect(action)
-        button.setIcon(QIcon(relative_path('resources/images/%s') % icon))
+        if icon:
+            button.setIcon(QIcon(relative_path('resources/images/%s') % icon))
+        else:
+            button.setText(tooltip)
         button.setToolTip(tooltip)
         self.addWidget(button)
 
@@ -110,9 +287,11 @@ class CodeWidget(QPlainTextEdit):
 
         # file paths
         self.file_path = ''
+        self.file_text = None  # contents last read from or written to file_path
         self.temp_dir_path = tempfile.mkdtemp('terminal')
         self.temp_asm_path = os.path.join(self.temp_dir_path, 'lab.asm')
         self.temp_hex_path = os.path.join(self.temp_dir_path, 'lab.hex')
+        self.temp_lst_path = os.path.join(self.temp_dir_path, 'lab.lst')
 
         # configuration
         self.comment_block = re.compile(' *; *[\*\=]{3,}')
@@ -146,6 +325,11 @@ class CodeWidget(QPlainTextEdit):
         # syntax highlighting
         self.syntax_highlighter = SyntaxHighlighter(self.document(), self.root.config)
 
+        # profiling heatmap
+        self.profile_stub = {name: int(value, 16) for name, value in self.root.config['profile'].items()}
+        self.heatmap_gutter = HeatmapGutter(self)
+        self.updateRequest.connect(self.heatmap_gutter.update)
+
         # serial
         self.terminal = self.root.terminal_widget
 
@@ -153,6 +337,11 @@ class CodeWidget(QPlainTextEdit):
         self._log_message = self.terminal._log_message
         self._log_error = self.terminal._log_error
 
+        # reload changes made to the file by other editors
+        self.auto_assemble = self.root.config['file'].getboolean('auto_assemble')
+        self.file_watcher = QFileSystemWatcher(self)
+        self.file_watcher.fileChanged.connect(self.reload)
+
         # open recent file if it exists
         recent_file = self.root.config['file']['last']
         if recent_file and os.path.exists(recent_file):
@@ -161,10 +350,15 @@ class CodeWidget(QPlainTextEdit):
             self.new()
 
     def assemble(self):
+        # no parameters since toolbar buttons pass their checked state
+        return self._assemble('')
+
+    def _assemble(self, appendix):
         # save code to temporary file and
         # add trailing newline to prevent as31 from throwing a syntax error
+        # code appended, like the profiling stub, comes after so error line numbers still match
         with open(self.temp_asm_path, 'w') as temp_asm_file:
-            temp_asm_file.write(self.toPlainText() + '\n')
+            temp_asm_file.write(self.toPlainText() + '\n' + appendix)
 
         # choose correct assembler
         if sys.platform == 'darwin':
@@ -338,26 +532,137 @@ class CodeWidget(QPlainTextEdit):
             self.suggestion.hide()
 
     def new(self):
-        self.file_path = ''
+        self._show_heatmap(None)
+        self._watch('')
         self.document().setPlainText('')
         self.document().clearUndoRedoStacks()
+        self.document().setModified(False)
         self.setExtraSelections([])
 
     def open(self, file_path=None):
         # get file_path
         if not file_path:
             # fixme: default/last path; only allow certain filetypes
-            file_path, filter = QFileDialog.getOpenFileName(self, 'Open...', filter='Assembly (*.asm *.txt)')
+            file_path, filter = QFileDialog.getOpenFileName(self, 'Open...', filter='Assembly (*.asm *.txt);;Intel hex (*.hex)')
             if not file_path:
                 return
+        # hex files open into the disassembly view instead
+        if file_path[-4:].lower() == '.hex':
+            self.root.disassembly_widget.open(file_path)
+            return
         # open file
         with open(file_path, 'r') as file:
-            code = self._clean(file.read())
+            self.file_text = file.read()
+            code = self._clean(self.file_text)
+            self._show_heatmap(None)
             self.document().setPlainText(code)
             self._align(0, None, len(code))
             self.document().clearUndoRedoStacks()
+            self.document().setModified(False)
             self.setExtraSelections([])
-        self.file_path = file_path
+        self._watch(file_path)
+
+    def profile(self):
+        # stop profiling but keep the heatmap up; the stub keeps sending samples until reset, so keep filtering them out
+        if self.terminal.profiler and self.terminal.profiler.counting:
+            self.terminal.profiler.counting = False
+            self._log_message('Profiling stopped. Hit RESET to stop the board sending samples.')
+            return
+        # assemble with the sampling stub linked in
+        stub = dict(self.profile_stub, scratch_high=self.profile_stub['scratch'] + 1,
+                    scratch_low=self.profile_stub['scratch'] + 2)
+        if not self._assemble(PROFILE_STUB % stub):
+            return
+        # make sure a port is open
+        if not self.terminal.serial_port:
+            self._log_error('No open connection.')
+            return
+        # map addresses back to lines of code
+        profiler = Profiler()
+        with open(self.temp_lst_path, 'r') as temp_lst_file:
+            profiler.map_listing(temp_lst_file.read(), self.document().blockCount())
+        if any(profiler.lines[address] for address in range(stub['vector'], stub['vector'] + 3)):
+            self._log_error('Code uses the timer 0 interrupt vector, which profiling needs.')
+            return
+        # send the profiling build and aggregate samples in the serial thread once it runs
+        with open(self.temp_hex_path, 'rb') as temp_hex_file:
+            hex_data = temp_hex_file.read()
+        self.terminal.profiler = profiler
+        self.terminal.serial_download(hex_data)
+        self._show_heatmap(profiler)
+        self._log_message('Run the code from %04X instead to profile it.' % stub['stub'])
+
+    def reload(self):
+        self._reload(10)
+
+    def _reload(self, retries):
+        # editors that save by replacing the file drop it from the watcher,
+        # and may leave no file at all for a moment, so check back a few times before giving up
+        self._watch(self.file_path)
+        if not self.file_path:
+            return
+        if not os.path.exists(self.file_path):
+            if retries:
+                QTimer.singleShot(100, lambda: self._reload(retries - 1))
+            else:
+                self._log_error('%s no longer exists. Stopped watching it.' % os.path.basename(self.file_path))
+            return
+        with open(self.file_path, 'r') as file:
+            file_text = file.read()
+        # ignore our own saves and changes that leave the file as it was
+        if file_text == self.file_text:
+            return
+        if self.document().isModified():
+            self._log_error('File changed by another program. Not reloaded, to keep unsaved changes.')
+            return
+
+        # diff the file against what it was last time rather than against the code, whose comments were aligned,
+        # so lines only the alignment changed are left alone; alignment keeps line numbers, so hunks still fit the code
+        # trailing newlines are left alone since save adds one
+        code_lines = self.toPlainText().rstrip('\n').split('\n')
+        old_lines = self._clean(self.file_text).rstrip('\n').split('\n')
+        file_lines = self._clean(file_text).rstrip('\n').split('\n')
+        if len(old_lines) != len(code_lines):
+            # cleaning gaps out of our own save shifted lines, so fall back on the code itself
+            old_lines = code_lines
+        self.file_text = file_text
+        hunks = difflib.SequenceMatcher(None, old_lines, file_lines, False).get_opcodes()
+
+        # replace only changed lines, last hunk first so earlier line numbers still hold, as one undo step
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()
+        for tag, code_start, code_end, file_start, file_end in reversed(hunks):
+            if tag == 'equal':
+                continue
+            lines = file_lines[file_start:file_end]
+            if code_end < len(code_lines):
+                # replace whole lines including their newlines
+                start = self.document().findBlockByNumber(code_start).position()
+                end = self.document().findBlockByNumber(code_end).position()
+                text = ''.join(line + '\n' for line in lines)
+            elif code_start > 0:
+                # hunk reaches the last line, so take the newline before it instead
+                block = self.document().findBlockByNumber(code_start - 1)
+                start = block.position() + block.length() - 1
+                block = self.document().findBlockByNumber(code_end - 1)
+                end = block.position() + block.length() - 1
+                text = ''.join('\n' + line for line in lines)
+            else:
+                block = self.document().findBlockByNumber(code_end - 1)
+                start, end = 0, block.position() + block.length() - 1
+                text = '\n'.join(lines)
+            cursor.setPosition(start)
+            cursor.setPosition(end, QTextCursor.KeepAnchor)
+            cursor.insertText(text)
+            self._align(start, end - start, len(text))
+        cursor.endEditBlock()
+        self.document().setModified(False)
+        # profile samples no longer line up with the changed lines
+        self._show_heatmap(None)
+        self._log_message('Reloaded %s.' % os.path.basename(self.file_path))
+
+        if self.auto_assemble:
+            self.assemble()
 
     def save(self):
         # get path
@@ -368,9 +673,16 @@ class CodeWidget(QPlainTextEdit):
                 return
         # save file
         # add trailing newline to prevent as31 from throwing a syntax error
+        self.file_text = self.toPlainText() + '\n'
         with open(file_path, 'w') as file:
-            file.write(self.toPlainText() + '\n')
-        self.file_path = file_path
+            file.write(self.file_text)
+        self.document().setModified(False)
+        self._watch(file_path)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        rect = self.contentsRect()
+        self.heatmap_gutter.setGeometry(rect.left(), rect.top(), self.heatmap_gutter.width(), rect.height())
 
     def send(self):
         # assemble code
@@ -393,6 +705,19 @@ class CodeWidget(QPlainTextEdit):
         elif sys.platform == 'win32':
             os.startfile(self.temp_dir_path)
 
+    def _show_heatmap(self, profiler):
+        self.heatmap_gutter.profiler = profiler
+        self.heatmap_gutter.setVisible(bool(profiler))
+        self.setViewportMargins(self.heatmap_gutter.width() if profiler else 0, 0, 0, 0)
+
+    def _watch(self, file_path):
+        if self.file_path != file_path:
+            if self.file_path in self.file_watcher.files():
+                self.file_watcher.removePath(self.file_path)
+            self.file_path = file_path
+        if file_path and os.path.exists(file_path) and file_path not in self.file_watcher.files():
+            self.file_watcher.addPath(file_path)
+
     def _align(self, position, removed, added):
         # fixme: can be optimized for speed
 
@@ -541,11 +866,53 @@ class CodeWidget(QPlainTextEdit):
 
     def _url_can_be_opened(self, url):
         path = url.toLocalFile()
-        if path[-4:] in ('.asm', '.txt') and os.path.exists(path):
+        if path[-4:].lower() in ('.asm', '.txt', '.hex') and os.path.exists(path):
             return True
         return False
 
 
+class HeatmapGutter(QWidget):
+
+    def __init__(self, code_widget):
+        super().__init__(code_widget)
+        self.code_widget = code_widget
+        self.profiler = None
+        self.line_counts = {}
+        self.setFixedWidth(QFontMetrics(code_widget.font()).averageCharWidth() * 5)
+        self.hide()
+
+        # fold samples into line counts periodically rather than per sample
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(500)
+
+    def paintEvent(self, event):
+        if not self.profiler:
+            return
+        painter = QPainter(self)
+        painter.setFont(self.code_widget.font())
+        maximum = max(self.line_counts.values(), default=0)
+        total = max(self.profiler.total, 1)
+        # shade visible lines by their share of samples
+        block = self.code_widget.firstVisibleBlock()
+        top = self.code_widget.blockBoundingGeometry(block).translated(self.code_widget.contentOffset()).top()
+        while block.isValid() and top <= event.rect().bottom():
+            height = self.code_widget.blockBoundingRect(block).height()
+            count = self.line_counts.get(block.blockNumber() + 1)
+            if count:
+                color = QColor(Qt.red)
+                color.setAlphaF(0.15 + 0.85 * count / maximum)
+                painter.fillRect(0, int(top), self.width(), int(height), color)
+                painter.drawText(QRectF(0, top, self.width() - 2, height), Qt.AlignRight, '%d%%' % (100 * count // total))
+            block = block.next()
+            top += height
+
+    def refresh(self):
+        if self.profiler and self.isVisible():
+            self.line_counts = self.profiler.line_counts()
+            self.update()
+
+
 class SyntaxHighlighter(QSyntaxHighlighter):
 
     def __init__(self, document, config):
@@ -585,6 +952,7 @@ class TerminalWidget(QPlainTextEdit):
     log_message = pyqtSignal(object)  # *args: message(str)
     data_received = pyqtSignal(object)  # *args: data(bytes)
     data_sent = pyqtSignal(object)  # *args: data(bytes)
+    memory_uploaded = pyqtSignal(object)  # *args: image(MemoryImage)
 
     def __init__(self, root, parent=None):
         super().__init__(parent)
@@ -609,16 +977,49 @@ class TerminalWidget(QPlainTextEdit):
         # serial interface thread
         self.baud_rate = int(self.root.config['serial']['baud_rate'])
         self.port_name = self.root.config['serial']['port_name']
+        self.port_override = self.root.port_name  # not saved to config.ini
         self.read_timeout = float(self.root.config['serial']['read_timeout'])
+        self.port_error = None  # why the last port name could never be opened, if it couldn't
         self.serial_port = None
         self.serial_thread = None
         self.serial_thread_close = threading.Event()
-        self.serial_queue = queue.Queue()
+        self.serial_queue = SerialScheduler(int(self.root.config['serial']['queue_size']))
+        self.serial_job = None  # job run a step at a time by serial_thread
+        self.download_timeout = float(self.root.config['serial']['download_timeout'])  # seconds on top of sending the data, including the wait for RESET
+        self.upload_timeout = float(self.root.config['serial']['upload_timeout'])
+        self.serial_listeners = []  # called by serial_thread with ('sent' or 'received', data, perf_counter_ns)
+
+        # response latency of the device, measured from the timestamps of every chunk sent and received
+        self.latency = LatencyStats()
+        self.serial_listeners.append(self.latency.record)
+
+        # profiling; while active samples are split off received data and aggregated in serial_thread
+        self.profiler = None
+
+        # binary capture; while active received data bypasses the text log
+        self.capture = None
+        self.capture_size = int(self.root.config['serial']['capture_size'])
+
+        # memory upload through minmon dump commands
+        self.downloaded_image = None  # last hex image sent, to diff uploads against
+        self.dump_command = self.root.config['memory']['dump_command']
+        self.dump_response = re.compile(self.root.config['memory']['dump_response'])
+        self.dump_length = int(self.root.config['memory']['dump_length'])  # bytes returned by one dump command
+        # dump commands kept outstanding at once; minmon polls a uart that holds a single byte, so characters
+        # sent while it prints a response are lost and it needs 1; only raise it for monitors that buffer input
+        self.dump_depth = int(self.root.config['memory']['dump_depth'])
+        self.dump_timeout = float(self.root.config['memory']['dump_timeout'])
 
         # signals needed for communication with thread; it throws errors when trying to manipulate QWidgets directly
         self.data_received.connect(self._log_serial)
         self.log_error.connect(self._log_error)
         self.log_message.connect(self._log_message)
+        self.memory_uploaded.connect(self._show_memory)
+
+        # show the state of bulk serial jobs in the status bar
+        self.job_timer = QTimer(self)
+        self.job_timer.timeout.connect(self._show_jobs)
+        self.job_timer.start(250)
 
         # start serial interface thread
         self._log_message('Searching for serial device...')
@@ -628,6 +1029,8 @@ class TerminalWidget(QPlainTextEdit):
 
     def closeEvent(self, event):
         self.serial_close()
+        if self.capture:
+            self.capture.close()
         self.root.config['serial']['baud_rate'] = str(self.baud_rate)
         self.root.config['serial']['port_name'] = self.port_name
 
@@ -662,6 +1065,56 @@ class TerminalWidget(QPlainTextEdit):
             cursor = QTextCursor(block)
             self.root.code_widget.setTextCursor(cursor)
 
+    def toggle_capture(self):
+        # stop capturing but leave the hex view up so the captured data can still be inspected
+        if self.capture:
+            capture, self.capture = self.capture, None
+            capture.close()
+            self._log_message('Binary capture stopped after %d bytes.' % capture.total)
+        # start capturing into a fresh ring, spilling everything received into a file of the user's choosing
+        else:
+            spill_path, filter = QFileDialog.getSaveFileName(self, 'Save capture as...', filter='Binary (*.bin)')
+            if not spill_path:
+                return
+            try:
+                self.capture = CaptureBuffer(self.capture_size, spill_path)
+            except OSError as error:
+                self._log_error('Could not save capture to %s: %s' % (os.path.basename(spill_path), error))
+                return
+            self.root.hex_widget.set_source(self.capture)
+            self._log_message('Binary capture started, saving to %s' % spill_path)
+
+    def cancel_jobs(self):
+        cancelled = self.serial_queue.cancel(SerialJob.BULK)
+        if cancelled:
+            self._log_message('Cancelling %s...' % ', '.join(job.action for job in cancelled))
+        else:
+            self._log_message('Nothing to cancel.')
+
+    def run_script(self):
+        file_path, filter = QFileDialog.getOpenFileName(self, 'Run test script...', filter='Test script (*.txt)')
+        if not file_path:
+            return
+        # run in its own thread so waiting on the device doesn't block the gui
+        runner = ScriptRunner(self, self.log_message.emit)
+        thread = threading.Thread(target=runner.run, args=(file_path,))
+        thread.setDaemon(1)
+        thread.start()
+
+    def upload_memory(self):
+        # ask for an inclusive hex address range, defaulting to the last one used
+        text, accepted = QInputDialog.getText(self, 'Upload memory', 'Address range (hex):',
+                                              text=self.root.config['memory']['range'])
+        match = re.match(' *([0-9a-fA-F]{1,4}) *- *([0-9a-fA-F]{1,4}) *$', text)
+        if not accepted:
+            return
+        if not match or int(match.group(2), 16) < int(match.group(1), 16):
+            self._log_error('Address range should look like 8000-ffff.')
+            return
+        self.root.config['memory']['range'] = text.strip()
+        start, end = int(match.group(1), 16), int(match.group(2), 16)
+        self.serial_upload(start, end - start + 1)
+
     def serial_close(self):
         if self.serial_port:
             # tell the listening thread to stop
@@ -677,8 +1130,15 @@ class TerminalWidget(QPlainTextEdit):
         if not self.serial_port:
             self.log_error.emit('No open connection.')
             return
-        # send data to serial_thread
-        self.serial_queue.put(('download', data))
+        # remember image to compare later memory uploads against
+        try:
+            self.downloaded_image = MemoryImage.from_intel_hex(data)
+        except ValueError:
+            self.downloaded_image = None
+            self.log_error.emit('Could not read the hex file, so later uploads won\'t be compared against it.')
+        # send data to serial_thread, allowing twice the time the data takes at 10 bits per byte
+        timeout = self.download_timeout + len(data) * 10 / self.baud_rate * 2
+        self._serial_put(SerialJob('download', data, SerialJob.BULK, timeout))
 
     def serial_interface(self):
 
@@ -689,13 +1149,23 @@ class TerminalWidget(QPlainTextEdit):
             if not self.serial_port:
                 # fixme: serial.tools.list_ports.comports()
                 port_names = [self.port_name] + ['/dev/tty.usbserial', 'com1']  # default and backup ports to scan
+                if self.port_override:
+                    port_names = [self.port_override]
                 for port_name in port_names:
                     # try opening a port
                     try:
                         # use a timeout to allow thread to check for serial_thread_close event and not get stuck at read
-                        self.serial_port = serial.Serial(port_name, baudrate=self.baud_rate, timeout=self.read_timeout)
+                        # urls such as loop:// or socket://host:port allow a local stand-in for the device
+                        self.serial_port = serial.serial_for_url(port_name, baudrate=self.baud_rate, timeout=self.read_timeout)
                     except serial.SerialException as exception:
                         self.serial_port = None
+                    except ValueError as error:
+                        # a malformed name or url will never open, so only say so once
+                        self.serial_port = None
+                        port_error = 'Bad port name %s: %s' % (port_name, error)
+                        if port_error != self.port_error:
+                            self.log_error.emit(port_error)
+                        self.port_error = port_error
                     if self.serial_port:
                         # fixme: reset queue?
                         self.log_message.emit('Device connected.')
@@ -703,75 +1173,79 @@ class TerminalWidget(QPlainTextEdit):
                 if not self.serial_port:
                     continue
 
-            # read data from device
-            # fixme: don'r switch off, causes issues; queue it somehow?
-            self._serial_read()
-
-            # write data to device
-            if not self.serial_queue.empty():
-
-                action, write_data = self.serial_queue.get()
-
-                if action == 'download':
-                    self.log_message.emit('Hit RESET in MON mode to download file...')
-                    # wait for r31jp to be ready
-                    while True:  # fixme: add a timeout
-                        read_data = self._serial_read()
-                        if read_data.endswith(b'*'):
-                            break
-                    # initiate transfer
-                    self._serial_write(b'd')
-                    while True:  # fixme: add a timeout
-                        read_data = self._serial_read()
-                        if read_data.endswith(b'>'):
-                            break
-                        '''
-                        elif read_data:
-                            # something went wrong
-                            self.log_error.emit('Error communicating with device. Data not sent.')
-                        '''
-                    # send data
-                    self.log_message.emit('Sending data...')
-                    # fixme: alternate read/write by record chunk to help show progress to user
-                    self._serial_write(write_data)
-                    while True:  # fixme: add a timeout?
-                        read_data = self._serial_read()
-                        if read_data and not read_data.endswith(b'.'):
-                            break
-                    self.log_message.emit('Data sent successfully.')
-
-                elif action == 'write':
-                    self._serial_write(write_data)
+            # read data from device, quietly if the active job parses it itself
+            job = self.serial_job
+            read_data = self._serial_read(quiet=bool(job and job.quiet))
+            if read_data is None:
+                if job:
+                    self._serial_finish(job, 'failed')
+                continue
 
-                else:
-                    raise ValueError()
+            # write data to device; queued jobs that outrank the active one run between its steps
+            queued_job = self.serial_queue.get(job)
+            if queued_job and queued_job.deadline and time.perf_counter() > queued_job.deadline:
+                # ran out of time while waiting its turn
+                queued_job.state = 'timed out'
+                self._serial_finish(queued_job, 'timed out')
+            elif queued_job and queued_job.action == 'write':
+                queued_job.state = 'running'
+                self._serial_write(queued_job.data)
+                self._serial_finish(queued_job, 'done')
+            elif queued_job:
+                job = self._serial_start(queued_job)
+
+            # advance the active job by one step
+            if job:
+                self._serial_step(job, read_data)
 
             # fixme: saves some power (?)
             # time.sleep(0.01)
 
-    def serial_write(self, data):
+    def serial_upload(self, start, length):
         # check that port is open
         if not self.serial_port:
-            self.log_message.emit('No open connection.')
+            self.log_error.emit('No open connection.')
             return
+        # send request to serial_thread
+        self._serial_put(SerialJob('upload', (start, length), SerialJob.BULK, self.upload_timeout, quiet=True))
+
+    def serial_write(self, data, block=False):
+        # returns whether the data was queued for the device
+        # check that port is open
+        if not self.serial_port:
+            self.log_message.emit('No open connection.')
+            return False
         # make sure data is in byte form
         if not isinstance(data, bytes):
             data = data.encode('utf-8')
         # send data to serial_thread
-        self.serial_queue.put(('write', data))
+        return self._serial_put(SerialJob('write', data, SerialJob.INTERACTIVE), block)
 
-    def _serial_read(self):
+    def _serial_read(self, quiet=False):
         try:
             # this method should only be called by the serial_thread
             data = self.serial_port.read()
             # may have timed out
             if data:
+                # stamp when the first bytes came back; later bytes of the chunk share it
+                received_time = time.perf_counter_ns()
                 # if there is more data to read
                 amount_waiting = self.serial_port.inWaiting()
                 if amount_waiting:
                     data += self.serial_port.read(size=amount_waiting)
-                # signal that data was received
-                self.data_received.emit(data)
+                # split off profiling samples so only the code's own output carries on
+                profiler = self.profiler
+                if profiler:
+                    data = profiler.feed(data)
+            if data:
+                for listener in tuple(self.serial_listeners):
+                    listener('received', data, received_time)
+                # capture raw bytes in this thread or signal that data was received
+                capture = self.capture
+                if capture:
+                    capture.write(data)
+                elif not quiet:
+                    self.data_received.emit(data)
             return data
         except Exception as exception:
             # fixme: only specific ones that imply device was disconnected
@@ -781,10 +1255,131 @@ class TerminalWidget(QPlainTextEdit):
             self.serial_port = None
             self.log_message.emit('Searching for serial device...')
 
+    def _serial_download(self, job):
+        # generator run a step at a time by serial_thread; each yield hands back the next data read
+        self.log_message.emit('Hit RESET in MON mode to download file...')
+        # wait for r31jp to be ready
+        read_data = yield
+        while not read_data.endswith(b'*'):
+            read_data = yield
+        # a reset board no longer sends samples from a stopped profiling run
+        profiler = self.profiler
+        if profiler and not profiler.counting:
+            self.profiler = None
+        # initiate transfer
+        self._serial_write(b'd')
+        read_data = yield
+        while not read_data.endswith(b'>'):
+            read_data = yield
+        # send data a record at a time so that interactive jobs can run in between
+        self.log_message.emit('Sending data...')
+        for record in job.data.splitlines(True):
+            self._serial_write(record)
+            read_data = yield
+        while not read_data or read_data.endswith(b'.'):
+            read_data = yield
+        self.log_message.emit('Data sent successfully.')
+
+    def _serial_finish(self, job, state):
+        # this method should only be called by the serial_thread
+        if job.steps:
+            job.steps.close()
+        if job.state == 'running':
+            job.state = state
+        if job is self.serial_job:
+            self.serial_job = None
+        if job.state in ('cancelled', 'timed out', 'failed') and job.action != 'write':
+            self.log_error.emit('%s %s.' % (job.action.capitalize(), job.state))
+        self.serial_queue.finish(job)
+
+    def _serial_put(self, job, block=False):
+        # producers that outrun the port are held back, or told so if they can't wait
+        try:
+            self.serial_queue.put(job, block)
+            return True
+        except queue.Full:
+            self.log_error.emit('Too much queued for the device; %s dropped.' % job.action)
+            return False
+
+    def _serial_start(self, job):
+        # this method should only be called by the serial_thread
+        job.state = 'running'
+        job.steps = getattr(self, '_serial_' + job.action)(job)
+        next(job.steps)
+        self.serial_job = job
+        return job
+
+    def _serial_step(self, job, read_data):
+        # this method should only be called by the serial_thread
+        if job.cancelled:
+            self._serial_finish(job, 'cancelled')
+        elif job.deadline and time.perf_counter() > job.deadline:
+            self._serial_finish(job, 'timed out')
+        else:
+            try:
+                job.steps.send(read_data)
+            except StopIteration:
+                self._serial_finish(job, 'done')
+
+    def _serial_upload(self, job):
+        # generator run a step at a time by serial_thread; each yield hands back the next data read
+        start, length = job.data
+        self.log_message.emit('Uploading %d bytes from %04X...' % (length, start))
+        image = bytearray(length)
+        missing = length
+        pending = collections.deque(range(start, start + length, self.dump_length))
+        outstanding = collections.deque()  # (address, time sent) of unanswered dump commands
+        retries = 0
+        text = ''
+        while pending or outstanding:
+            # send the next dump commands as earlier ones are answered, up to dump_depth at once
+            while pending and len(outstanding) < self.dump_depth:
+                address = pending.popleft()
+                command = self.dump_command.format(address=address)
+                self._serial_write(command.encode('ascii').decode('unicode_escape').encode('latin-1'))
+                outstanding.append((address, time.time()))
+            # collect responses, which the quiet job keeps out of the terminal
+            read_data = yield
+            text += read_data.decode('ascii', 'ignore')
+            # parse complete lines only
+            lines = re.split('\r|\n', text)
+            text = lines.pop()
+            for line in lines:
+                match = self.dump_response.search(line)
+                if not match or not outstanding:
+                    continue
+                # responses carry their address or else arrive in the order they were requested
+                if 'address' in self.dump_response.groupindex:
+                    address = int(match.group('address'), 16)
+                    if address not in [a for a, t in outstanding]:
+                        continue
+                    outstanding = collections.deque((a, t) for a, t in outstanding if a != address)
+                else:
+                    address = outstanding.popleft()[0]
+                data = bytes.fromhex(match.group('data'))[:min(self.dump_length, start + length - address)]
+                image[address - start:address - start + len(data)] = data
+                missing -= len(data)
+                retries = 0
+            # re-request anything that went unanswered
+            if outstanding and time.time() - outstanding[0][1] > self.dump_timeout:
+                retries += 1
+                if retries > 3:
+                    self.log_error.emit('Device stopped answering dump commands. Upload aborted.')
+                    job.state = 'failed'
+                    return
+                pending.extendleft(reversed([a for a, t in outstanding]))
+                outstanding.clear()
+        if missing > 0:
+            self.log_error.emit('%d bytes could not be parsed from the dump responses.' % missing)
+        self.memory_uploaded.emit(MemoryImage(start, image, reference=self.downloaded_image))
+
     def _serial_write(self, data):
         # for byte in data:
         self.serial_port.write(data)
         self.serial_port.flush()
+        sent_time = time.perf_counter_ns()
+        for listener in tuple(self.serial_listeners):
+            listener('sent', data, sent_time)
         # signal that data was sent
         self.data_sent.emit(data)
 
@@ -805,6 +1400,21 @@ class TerminalWidget(QPlainTextEdit):
         self.logging_serial = False
         self._log(text, self.message_style)
 
+    def _show_jobs(self):
+        jobs = [job for job in self.serial_queue.jobs() if job.priority == SerialJob.BULK]
+        if jobs:
+            self.root.statusBar().showMessage(', '.join('%s %s' % (job.action, job.state) for job in jobs))
+        else:
+            self.root.statusBar().clearMessage()
+
+    def _show_memory(self, image):
+        # show uploaded memory in the hex view, marking bytes that differ from the last download
+        self.root.hex_widget.set_source(image)
+        self._log_message('Upload complete.')
+        if image.reference:
+            differences = image.differences(image.start(), image.end() - image.start())
+            self._log_message('%d bytes differ from the last downloaded hex file.' % len(differences))
+
     def _log_serial(self, data):
         # log data received from connected device
         try:
@@ -829,9 +1439,835 @@ class TerminalWidget(QPlainTextEdit):
             self._log(text, self.serial_style)
 
 
+class SerialJob:
+
+    # priorities; lower numbers run first
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, action, data, priority, timeout=None, quiet=False):
+        self.action = action  # 'write', 'download' or 'upload'
+        self.data = data
+        self.priority = priority
+        self.deadline = time.perf_counter() + timeout if timeout else None
+        self.quiet = quiet  # keep data read while running out of the terminal
+        self.state = 'queued'  # queued, running, done, cancelled, timed out or failed
+        self.cancelled = False
+        self.steps = None  # generator stepped by serial_thread while running
+
+    def cancel(self):
+        # serial_thread stops the job before its next step
+        self.cancelled = True
+
+
+class SerialScheduler:
+
+    def __init__(self, capacity):
+        self.capacity = capacity  # queued jobs allowed before producers are held back
+        self.condition = threading.Condition()
+        self.queued = []  # heap of (priority, count, job)
+        self.count = 0  # keeps jobs of equal priority in fifo order
+        self.active = []  # queued and running jobs, for the gui
+
+    def cancel(self, priority=None):
+        # cancel queued and running jobs, optionally only those of one priority;
+        # queued ones are dropped at once so they stop taking up room, running ones stop before their next step
+        with self.condition:
+            jobs = [job for job in self.active if priority is None or job.priority == priority]
+            for job in jobs:
+                job.cancel()
+                if job.state == 'queued':
+                    job.state = 'cancelled'
+                    self.active.remove(job)
+            self.queued = [entry for entry in self.queued if entry[2].state == 'queued']
+            heapq.heapify(self.queued)
+            self.condition.notify_all()
+            return jobs
+
+    def finish(self, job):
+        with self.condition:
+            if job in self.active:
+                self.active.remove(job)
+
+    def get(self, running=None):
+        # next job to run, skipping cancelled ones; only jobs outranking a running one are returned
+        with self.condition:
+            while self.queued:
+                priority, count, job = self.queued[0]
+                if running and priority >= running.priority:
+                    return None
+                heapq.heappop(self.queued)
+                self.condition.notify_all()
+                if not job.cancelled:
+                    return job
+                job.state = 'cancelled'
+                self.active.remove(job)
+            return None
+
+    def jobs(self):
+        with self.condition:
+            return list(self.active)
+
+    def put(self, job, block=True, timeout=None):
+        # back-pressure: wait for room in the queue, raising queue.Full if there is none
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.queued) < self.capacity, timeout if block else 0):
+                raise queue.Full()
+            heapq.heappush(self.queued, (job.priority, self.count, job))
+            self.count += 1
+            self.active.append(job)
+        return job
+
+
+class ScriptRunner:
+
+    # script lines look like:
+    #   # comment
+    #   send 'g8000\r'            send a python str or bytes literal
+    #   expect 'Ready.*\n' 2.0    wait for a regex match, with an optional timeout in seconds
+    #   expect_bytes b'\x55' 0.5  wait for an exact byte sequence
+    #   sleep 0.5                 pause
+    #   timeout 5                 change the default expect timeout
+
+    def __init__(self, terminal, log=print):
+        self.terminal = terminal
+        self.log = log
+        self.connect_timeout = 5.0
+        self.timeout = 2.0
+        self.received = queue.Queue()  # (perf_counter_ns received, data) from serial_thread
+        self.buffer = b''  # received data not yet consumed by an expect
+        self.sent_time = self.received_time = time.perf_counter_ns()
+
+    def run(self, file_path):
+        # returns whether every step in the script passed
+        try:
+            with open(file_path, 'r') as file:
+                steps = self._parse(file.read())
+        except (OSError, ValueError, SyntaxError) as error:
+            self.log('%s: %s' % (file_path, error))
+            return False
+
+        # wait for the serial thread to find the device
+        deadline = time.perf_counter() + self.connect_timeout
+        while not self.terminal.serial_port:
+            if time.perf_counter() > deadline:
+                self.log('%s: no open connection.%s' % (file_path, ' ' + self.terminal.port_error if self.terminal.port_error else ''))
+                return False
+            time.sleep(0.05)
+
+        self.terminal.serial_listeners.append(self._receive)
+        try:
+            passed = sum(self._run_step(*step) for step in steps)
+        finally:
+            self.terminal.serial_listeners.remove(self._receive)
+        self.log('%s: %d of %d steps passed.' % (file_path, passed, len(steps)))
+        return passed == len(steps)
+
+    def _parse(self, script):
+        steps = []
+        for number, line in enumerate(script.split('\n'), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            command, _, argument = line.partition(' ')
+            argument = argument.strip()
+            try:
+                if command == 'send':
+                    steps.append((number, command, self._bytes(argument), None))
+                elif command in ('expect', 'expect_bytes'):
+                    pattern, timeout = re.match(r'(.*?)(?:\s+([0-9.]+))?$', argument).groups()
+                    pattern = self._bytes(pattern)
+                    if command == 'expect_bytes':
+                        pattern = re.escape(pattern)
+                    steps.append((number, command, re.compile(pattern), float(timeout) if timeout else None))
+                elif command in ('sleep', 'timeout'):
+                    steps.append((number, command, float(argument), None))
+                else:
+                    raise ValueError('unknown command %r' % command)
+            except (ValueError, SyntaxError, re.error) as error:
+                raise ValueError('line %d: %s' % (number, error))
+        return steps
+
+    def _bytes(self, literal):
+        value = ast.literal_eval(literal)
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if not isinstance(value, bytes):
+            raise ValueError('expected a str or bytes literal, got %r' % literal)
+        return value
+
+    def _receive(self, direction, data, time_ns):
+        # called by serial_thread
+        if direction == 'sent':
+            self.sent_time = time_ns
+        else:
+            self.received.put((time_ns, data))
+
+    def _run_step(self, number, command, argument, timeout):
+        if command == 'send':
+            # forget anything left over so expects only see what follows this send
+            self.buffer = b''
+            while not self.received.empty():
+                self.received.get()
+            if not self.terminal.serial_write(argument, block=True):
+                self.log('line %d: FAIL send %r, no open connection' % (number, argument))
+                return False
+            return True
+        if command == 'sleep':
+            time.sleep(argument)
+            return True
+        if command == 'timeout':
+            self.timeout = argument
+            return True
+
+        # wait for pattern, timing the response from the last chunk sent to the chunk that completed the match
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.perf_counter() + timeout
+        while True:
+            match = argument.search(self.buffer)
+            if match:
+                self.buffer = self.buffer[match.end():]
+                self.log('line %d: PASS %s %r in %.1f ms' %
+                         (number, command, argument.pattern, (self.received_time - self.sent_time) / 1e6))
+                return True
+            try:
+                self.received_time, data = self.received.get(timeout=max(0, deadline - time.perf_counter()))
+                self.buffer += data
+            except queue.Empty:
+                self.log('line %d: FAIL %s %r timed out after %.1f s, received %r' %
+                         (number, command, argument.pattern, timeout, self.buffer[-80:]))
+                self.buffer = b''
+                return False
+
+
+class Profiler:
+
+    SYNC = 0xa5  # first byte of each (sync, pc high, pc low) sample sent by PROFILE_STUB
+
+    def __init__(self):
+        self.counts = array.array('L', bytes(array.array('L').itemsize * 0x10000))  # samples per address
+        self.lines = array.array('H', bytes(2 * 0x10000))  # line of code per address, 0 if none
+        self.addresses = []  # addresses that map to a line of code
+        self.total = 0
+        self.counting = True  # once stopped, samples are still split off but no longer counted
+        self.state = 0  # bytes of the current sample seen
+        self.high = 0
+
+    def feed(self, data):
+        # this method should only be called by the serial_thread; returns data that was not part of a sample
+        if not self.state and self.SYNC not in data:
+            return data
+        passed = bytearray()
+        for byte in data:
+            if self.state == 0:
+                if byte == self.SYNC:
+                    self.state = 1
+                else:
+                    passed.append(byte)
+            elif self.state == 1:
+                self.high = byte
+                self.state = 2
+            else:
+                if self.counting:
+                    self.counts[self.high << 8 | byte] += 1
+                    self.total += 1
+                self.state = 0
+        return bytes(passed)
+
+    def line_counts(self):
+        counts = collections.Counter()
+        for address in self.addresses:
+            if self.counts[address]:
+                counts[self.lines[address]] += self.counts[address]
+        return counts
+
+    def map_listing(self, listing, line_count):
+        # as31 lists each source line once, after continuation lines of 18 characters for bytes past the fourth
+        line, address, size = 1, None, 0
+        for text in listing.split('\n'):
+            if re.match('[0-9A-F]{4}: ', text):
+                address = int(text[:4], 16)
+            size += len(text[6:18].split())
+            if len(text) == 18:
+                continue
+            if address is not None and line <= line_count:
+                for offset in range(size):
+                    self.lines[(address + offset) & 0xffff] = line
+                    self.addresses.append((address + offset) & 0xffff)
+            line, address, size = line + 1, None, 0
+
+
+class CaptureBuffer:
+
+    def __init__(self, size, spill_path=None):
+        # preallocated ring of the most recent bytes; chunks are copied in place so no per-byte objects are created
+        self.size = size
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.total = 0  # bytes written since capture started; absolute offset of the next byte
+        self.lock = threading.Lock()  # written by serial_thread, read by the gui
+        # everything is also spilled to a file so nothing is lost once the ring wraps
+        self.spill_file = open(spill_path, 'wb') if spill_path else None
+
+    def close(self):
+        with self.lock:
+            if self.spill_file:
+                self.spill_file.close()
+                self.spill_file = None
+
+    def start(self):
+        # absolute offset of the oldest byte still held in the ring
+        return max(0, self.total - self.size)
+
+    def end(self):
+        return self.total
+
+    def read(self, offset, length):
+        # copy out the bytes at absolute offsets [offset, offset + length) that are still held in the ring
+        with self.lock:
+            end = min(offset + length, self.total)
+            offset = max(offset, self.total - self.size, 0)
+            length = end - offset
+            if length <= 0:
+                return b''
+            position = offset % self.size
+            if position + length <= self.size:
+                return bytes(self.view[position:position + length])
+            return bytes(self.view[position:]) + bytes(self.view[:position + length - self.size])
+
+    def write(self, data):
+        # this method should only be called by the serial_thread
+        with self.lock:
+            view = memoryview(data)
+            # only the tail of an oversized chunk fits in the ring
+            if len(view) > self.size:
+                view = view[len(view) - self.size:]
+            position = (self.total + len(data) - len(view)) % self.size
+            first = min(len(view), self.size - position)
+            self.view[position:position + first] = view[:first]
+            self.view[:len(view) - first] = view[first:]
+            self.total += len(data)
+            if self.spill_file:
+                self.spill_file.write(data)
+
+
+class LatencyStats:
+
+    def __init__(self, size=4096, burst_gap=0.1):
+        self.lock = threading.Lock()  # fed by serial_thread, read by the gui
+        self.burst_gap = int(burst_gap * 1e9)  # longer silences end a burst of received data
+        # most recent samples in nanoseconds
+        self.response = collections.deque(maxlen=size)  # from a chunk sent to the first data received after it
+        self.inter_byte = collections.deque(maxlen=size)  # between chunks received in one burst, per byte
+        self.sent_time = None
+        self.received_time = None
+
+    def clear(self):
+        with self.lock:
+            self.response.clear()
+            self.inter_byte.clear()
+            self.sent_time = self.received_time = None
+
+    def record(self, direction, data, time_ns):
+        # serial listener; resolution is limited to whole chunks, which the read timeout bounds
+        with self.lock:
+            if direction == 'sent':
+                self.sent_time = time_ns
+                return
+            if self.sent_time is not None:
+                self.response.append(time_ns - self.sent_time)
+                self.sent_time = None
+            elif self.received_time is not None and time_ns - self.received_time < self.burst_gap:
+                self.inter_byte.append((time_ns - self.received_time) // len(data))
+            self.received_time = time_ns
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.response), sorted(self.inter_byte)
+
+    def histogram(samples, buckets=24):
+        # counts per power of two microseconds; the last bucket collects everything slower
+        counts = [0] * buckets
+        for sample in samples:
+            counts[min(buckets - 1, (sample // 1000).bit_length())] += 1
+        return counts
+
+    def percentile(samples, fraction):
+        # samples must be sorted
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] if samples else 0
+
+
+class LatencyWidget(QWidget):
+
+    def __init__(self, latency, parent=None):
+        super().__init__(parent)
+        self.latency = latency
+        self.bar_color = QColor(Qt.darkBlue)
+
+        fixed_font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        fixed_font.setPixelSize(12)
+        self.setFont(fixed_font)
+        self.setMinimumWidth(QFontMetrics(fixed_font).averageCharWidth() * 60)
+
+        # redraw periodically while shown rather than for every chunk
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.update)
+        self.refresh_timer.start(500)
+
+    def toggle(self):
+        # measurements start afresh each time the histograms are shown
+        if self.isVisible():
+            self.hide()
+        else:
+            self.latency.clear()
+            self.show()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        response, inter_byte = self.latency.snapshot()
+        height = self.height() // 2
+        self._paint_histogram(painter, QRect(0, 0, self.width(), height), 'Response', response)
+        self._paint_histogram(painter, QRect(0, height, self.width(), height), 'Inter-byte', inter_byte)
+
+    def _paint_histogram(self, painter, rect, title, samples):
+        metrics = painter.fontMetrics()
+        line = metrics.height()
+        text = '%s: %d samples' % (title, len(samples))
+        if samples:
+            text += ', p50 %s  p90 %s  p99 %s  max %s' % tuple(
+                LatencyWidget._duration(LatencyStats.percentile(samples, f)) for f in (0.5, 0.9, 0.99, 1))
+        painter.drawText(rect.left() + 4, rect.top() + line, text)
+
+        # one bar per power of two microseconds, labelled every fourth bucket
+        counts = LatencyStats.histogram(samples)
+        area = rect.adjusted(4, line + 4, -4, -line - 4)
+        width = area.width() / len(counts)
+        for index, count in enumerate(counts):
+            x = int(area.left() + index * width)
+            if count:
+                bar = int(area.height() * count / max(counts))
+                painter.fillRect(x, area.bottom() - bar, max(1, int(width) - 1), bar, self.bar_color)
+            if index % 4 == 0:
+                painter.drawText(x, rect.bottom() - 4, LatencyWidget._duration(1000 << index >> 1))
+
+    def _duration(ns):
+        if ns < 1000000:
+            return '%dus' % (ns // 1000)
+        if ns < 1000000000:
+            return '%.1fms' % (ns / 1e6)
+        return '%.2fs' % (ns / 1e9)
+
+
+class MemoryImage:
+
+    def __init__(self, address, data, loaded=None, reference=None):
+        self.address = address  # address of the first byte of data
+        self.data = data
+        self.loaded = loaded  # per byte flags for images with gaps, None if every byte is known
+        self.reference = reference  # image to report differences against
+
+    def from_intel_hex(data):
+        # collect data records, honouring extended address records
+        records = []
+        base = 0
+        for line in data.decode('ascii', 'ignore').split('\n'):
+            line = line.strip()
+            if not line.startswith(':'):
+                continue
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xff:
+                raise ValueError('Corrupt hex record: %s' % line)
+            kind, address = record[3], base + (record[1] << 8 | record[2])
+            if kind == 0:
+                records.append((address, record[4:-1]))
+            elif kind == 1:
+                break
+            elif kind == 2:
+                base = (record[4] << 8 | record[5]) << 4
+            elif kind == 4:
+                base = (record[4] << 8 | record[5]) << 16
+        if not records:
+            return MemoryImage(0, bytearray(), bytearray())
+        # lay records out in one image, flagging which bytes they cover
+        start = min(address for address, record in records)
+        end = max(address + len(record) for address, record in records)
+        image = MemoryImage(start, bytearray(end - start), bytearray(end - start))
+        for address, record in records:
+            image.data[address - start:address - start + len(record)] = record
+            image.loaded[address - start:address - start + len(record)] = b'\x01' * len(record)
+        return image
+
+    def start(self):
+        return self.address
+
+    def end(self):
+        return self.address + len(self.data)
+
+    def contains(self, address):
+        if not self.address <= address < self.end():
+            return False
+        return not self.loaded or bool(self.loaded[address - self.address])
+
+    def read(self, offset, length):
+        start = max(offset, self.address) - self.address
+        return bytes(self.data[start:max(start, offset + length - self.address)])
+
+    def differences(self, offset, length):
+        # addresses in range whose bytes differ from those the reference image defines
+        if not self.reference:
+            return []
+        return [address for address in range(max(offset, self.address), min(offset + length, self.end()))
+                if self.reference.contains(address) and
+                self.reference.data[address - self.reference.address] != self.data[address - self.address]]
+
+
+class Disassembly:
+
+    VECTORS = (0x00, 0x03, 0x0b, 0x13, 0x1b, 0x23, 0x2b)  # reset and interrupt vectors
+    REGION = 64  # rows formatted together as they are first shown
+    ORG, INSTRUCTION, DATA = range(3)  # kinds of row
+
+    def __init__(self, image):
+        self.image = image
+        self.code = bytearray(len(image.data))  # 1 at instruction starts, 2 over their operands
+        self.targets = set()  # addresses jumped or called to, labelled if they start an instruction
+        self.regions = collections.OrderedDict()  # recently shown regions of formatted rows
+
+        # follow the flow of code from the vectors, both at 0 and at the start of the image since
+        # code downloaded into the r31jp has its vectors redirected there; sweep through what is left
+        # decoding is done for the whole image up front (under 0.1 s for 64 KiB): code anywhere can jump into
+        # any region, which then needs a label, and the scroll bar needs the total number of rows
+        self._descend([base + vector for base in (0, image.start()) for vector in self.VECTORS])
+        self._sweep()
+
+        # only the address and kind of each row are kept; text is made when a region is shown
+        self.rows = array.array('L')
+        self.kinds = bytearray()
+        end = None
+        for index in range(len(self.code)):
+            if self.code[index] == 2 or (self.image.loaded and not self.image.loaded[index]):
+                continue
+            address = self.image.address + index
+            if address != end:
+                self.rows.append(address)
+                self.kinds.append(self.ORG)
+            if self.code[index] == 1:
+                end = address + OPCODES_8051[self.image.data[index]][2]
+                self.rows.append(address)
+                self.kinds.append(self.INSTRUCTION)
+            elif not self.code[index]:
+                end = address + 1
+                # up to eight data bytes per row
+                if self.kinds[-1] != self.DATA or (address - self.rows[-1]) % 8 == 0:
+                    self.rows.append(address)
+                    self.kinds.append(self.DATA)
+
+    def row(self, index):
+        # (address, length, text) of a row, formatting its whole region the first time it is needed
+        region = index // self.REGION
+        if region in self.regions:
+            self.regions.move_to_end(region)
+        else:
+            rows = range(region * self.REGION, min(len(self.rows), (region + 1) * self.REGION))
+            self.regions[region] = [self._format(row) for row in rows]
+            if len(self.regions) > 256:
+                self.regions.popitem(False)
+        return self.regions[region][index % self.REGION]
+
+    def text(self):
+        # assembly that reassembles to the same image
+        return '\n'.join(self.row(index)[2] for index in range(len(self.rows))) + '\n'
+
+    def _claim(self, address):
+        # mark an instruction if all of its bytes are loaded and not already taken by another,
+        # returning its table entry; jumps that wrap around memory can't be reassembled so are left as data
+        index = address - self.image.address
+        opcode = OPCODES_8051[self.image.data[index]] if 0 <= index < len(self.code) else None
+        if not opcode or index + opcode[2] > len(self.code):
+            return None
+        for offset in range(index, index + opcode[2]):
+            if self.code[offset] or (self.image.loaded and not self.image.loaded[offset]):
+                return None
+        if not 0 <= (self._target(address) or 0) <= 0xffff:
+            return None
+        self.code[index] = 1
+        self.code[index + 1:index + opcode[2]] = b'\x02' * (opcode[2] - 1)
+        return opcode
+
+    def _descend(self, entries):
+        stack = [entry for entry in entries if self.image.contains(entry)]
+        while stack:
+            address = stack.pop()
+            while True:
+                opcode = self._claim(address)
+                if not opcode:
+                    break
+                target = self._target(address)
+                if target is not None:
+                    self.targets.add(target)
+                    stack.append(target)
+                if opcode[3] in ('jump', 'return'):
+                    break
+                address += opcode[2]
+
+    def _format(self, index):
+        address, kind = self.rows[index], self.kinds[index]
+        if kind == self.ORG:
+            return address, 0, '        .org    0%04xh' % address
+        data = self.image.data
+        start = address - self.image.address
+        if kind == self.DATA:
+            length = 1
+            while (length < 8 and start + length < len(data) and not self.code[start + length] and
+                   (not self.image.loaded or self.image.loaded[start + length])):
+                length += 1
+            return address, length, '        .db     ' + ', '.join('0%02xh' % b for b in data[start:start + length])
+
+        mnemonic, operands, length, flow = OPCODES_8051[data[start]]
+        values = iter(data[start + 1:start + length])
+        texts = []
+        for operand in operands:
+            if operand in ('direct', 'bit'):
+                texts.append('0%02xh' % next(values))
+            elif operand == '/bit':
+                texts.append('/0%02xh' % next(values))
+            elif operand == '#data':
+                texts.append('#0%02xh' % next(values))
+            elif operand == '#data16':
+                texts.append('#0%04xh' % (next(values) << 8 | next(values)))
+            elif operand in ('rel', 'addr11', 'addr16'):
+                target = self._target(address)
+                texts.append('L%04X' % target if self._is_instruction(target) else '0%04xh' % target)
+            else:
+                texts.append(operand)
+        if data[start] == 0x85:
+            texts.reverse()  # mov direct, direct encodes the source first
+        label = 'L%04X:' % address if address in self.targets else ''
+        return address, length, ('%-8s%-8s%s' % (label, mnemonic, ', '.join(texts))).rstrip()
+
+    def _is_instruction(self, address):
+        index = address - self.image.address
+        return 0 <= index < len(self.code) and self.code[index] == 1
+
+    def _sweep(self):
+        # decode whatever the code flow didn't reach linearly, leaving what won't decode as data
+        index = 0
+        while index < len(self.code):
+            address = self.image.address + index
+            opcode = not self.code[index] and self._claim(address)
+            if opcode:
+                target = self._target(address)
+                if target is not None:
+                    self.targets.add(target)
+                index += opcode[2]
+            else:
+                index += 1
+
+    def _target(self, address):
+        # address a jump, branch or call goes to, outside 0 to ffff if it wraps around memory
+        data, start = self.image.data, address - self.image.address
+        mnemonic, operands, length, flow = OPCODES_8051[data[start]]
+        if not flow or flow == 'return':
+            return None
+        if operands[-1] == 'rel':
+            offset = data[start + length - 1]
+            return address + length + offset - (offset & 0x80) * 2
+        if operands[-1] == 'addr11':
+            return ((address + 2) & 0x1f800) | (data[start] & 0xe0) << 3 | data[start + 1]
+        return data[start + 1] << 8 | data[start + 2]
+
+
+class DisassemblyWidget(QAbstractScrollArea):
+
+    def __init__(self, root, parent=None):
+        super().__init__(parent)
+        self.root = root
+        self.disassembly = None
+
+        # monospaced font & row size
+        fixed_font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        fixed_font.setPixelSize(12)
+        self.setFont(fixed_font)
+        self.row_height = QFontMetrics(fixed_font).height()
+        self.setMinimumWidth(QFontMetrics(fixed_font).averageCharWidth() * 60)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+
+        # logging
+        self._log_message = self.root.terminal_widget._log_message
+        self._log_error = self.root.terminal_widget._log_error
+
+    def contextMenuEvent(self, event):
+        if not self.disassembly:
+            return
+        menu = QMenu(self)
+        menu.addAction('Edit as assembly', self.edit)
+        menu.addAction('Close', self.hide)
+        menu.exec_(event.globalPos())
+
+    def edit(self):
+        # open the disassembly in the code editor so it can be changed and sent as usual
+        code_widget = self.root.code_widget
+        code_widget.new()
+        code_widget.document().setPlainText(self.disassembly.text())
+        code_widget.document().clearUndoRedoStacks()
+
+    def open(self, file_path):
+        try:
+            with open(file_path, 'rb') as file:
+                image = MemoryImage.from_intel_hex(file.read())
+        except (OSError, ValueError) as error:
+            self._log_error('Could not open %s: %s' % (os.path.basename(file_path), error))
+            return
+        self.disassembly = Disassembly(image)
+        self.verticalScrollBar().setValue(0)
+        self._update_scroll_bar()
+        self.show()
+        self._log_message('Disassembled %s; right click it to edit as assembly.' % os.path.basename(file_path))
+
+    def paintEvent(self, event):
+        if not self.disassembly:
+            return
+        painter = QPainter(self.viewport())
+        painter.setFont(self.font())
+        data, base = self.disassembly.image.data, self.disassembly.image.address
+        first_row = self.verticalScrollBar().value()
+        # only paint the rows that are visible
+        for index in range(first_row, min(len(self.disassembly.rows), first_row + self._visible_rows() + 1)):
+            address, length, text = self.disassembly.row(index)
+            code = ' '.join('%02X' % b for b in data[address - base:address - base + min(length, 4)])
+            text = '%04X  %-12s  %s' % (address, code, text) if length else ' ' * 20 + text
+            y = (index - first_row + 1) * self.row_height - painter.fontMetrics().descent()
+            painter.drawText(4, y, text)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_scroll_bar()
+
+    def scrollContentsBy(self, dx, dy):
+        # rows are painted from the scroll bar value, not scrolled as pixels
+        self.viewport().update()
+
+    def _update_scroll_bar(self):
+        rows = len(self.disassembly.rows) if self.disassembly else 0
+        self.verticalScrollBar().setRange(0, max(0, rows - self._visible_rows()))
+        self.verticalScrollBar().setPageStep(self._visible_rows())
+        self.viewport().update()
+
+    def _visible_rows(self):
+        return self.viewport().height() // self.row_height
+
+
+class HexWidget(QAbstractScrollArea):
+
+    # printable ascii kept as is, everything else shown as '.'
+    ASCII_TABLE = bytes(b if 32 <= b < 127 else ord('.') for b in range(256))
+
+    def __init__(self, root, parent=None):
+        super().__init__(parent)
+        self.root = root
+
+        # data shown; any object with start(), end() and read(offset, length) over absolute offsets,
+        # optionally with differences(offset, length) listing offsets to mark
+        self.source = None
+        self.row_length = 16
+        self.difference_color = QColor(Qt.red).lighter(170)
+
+        # monospaced font & row size
+        fixed_font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        fixed_font.setPixelSize(12)
+        self.setFont(fixed_font)
+        self.char_width = QFontMetrics(fixed_font).averageCharWidth()
+        self.row_height = QFontMetrics(fixed_font).height()
+        self.setMinimumWidth(self.char_width * (10 + 4 * self.row_length + 2) + self.verticalScrollBar().sizeHint().width())
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+
+        # poll the source rather than repainting for every received chunk
+        self.source_end = None
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(50)
+
+    def paintEvent(self, event):
+        if not self.source:
+            return
+        painter = QPainter(self.viewport())
+        painter.setFont(self.font())
+        start, end = self.source.start(), self.source.end()
+        differences = getattr(self.source, 'differences', None)
+        first_row = start // self.row_length + self.verticalScrollBar().value()
+        # only paint the rows that are visible
+        for index in range(self._visible_rows() + 1):
+            offset = (first_row + index) * self.row_length
+            if offset >= end:
+                break
+            data = self.source.read(offset, self.row_length)
+            # leading bytes of the oldest row may already have been overwritten
+            skip = max(0, start - offset)
+            # mark bytes that differ from the source's reference image
+            if differences:
+                for address in differences(offset, self.row_length):
+                    x = 4 + self.char_width * (10 + 3 * (address - offset))
+                    painter.fillRect(x, index * self.row_height, self.char_width * 2, self.row_height, self.difference_color)
+            hex_text = '   ' * skip + ' '.join('%02X' % b for b in data)
+            ascii_text = ' ' * skip + data.translate(self.ASCII_TABLE).decode('ascii')
+            text = '%08X  %-*s  %s' % (offset, 3 * self.row_length - 1, hex_text, ascii_text)
+            painter.drawText(4, (index + 1) * self.row_height - painter.fontMetrics().descent(), text)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.source_end = None
+        self.refresh()
+
+    def scrollContentsBy(self, dx, dy):
+        # rows are painted from the scroll bar value, not scrolled as pixels
+        self.viewport().update()
+
+    def set_source(self, source):
+        # forget the last end seen so a new source of the same size is still repainted
+        self.source = source
+        self.source_end = None
+        self.show()
+        self.refresh()
+
+    def refresh(self):
+        if not self.source or not self.isVisible():
+            return
+        end = self.source.end()
+        if end == self.source_end:
+            return
+        self.source_end = end
+        # keep following the newest data if scrolled to the bottom
+        scroll_bar = self.verticalScrollBar()
+        following = scroll_bar.value() == scroll_bar.maximum()
+        rows = (end + self.row_length - 1) // self.row_length - self.source.start() // self.row_length
+        scroll_bar.setRange(0, max(0, rows - self._visible_rows()))
+        scroll_bar.setPageStep(self._visible_rows())
+        if following:
+            scroll_bar.setValue(scroll_bar.maximum())
+        self.viewport().update()
+
+    def _visible_rows(self):
+        return self.viewport().height() // self.row_height
+
+
 def launch():
-    application = QApplication(sys.argv)
-    main_window = MainWindow()
+    parser = argparse.ArgumentParser(description='IDE for the R-31JP system used in MITs course 6.115')
+    parser.add_argument('--port', help='serial port or pySerial url to use instead of the configured one')
+    parser.add_argument('--test', nargs='+', metavar='SCRIPT', help='run test scripts without showing the IDE')
+    arguments, qt_arguments = parser.parse_known_args()
+
+    # run test scripts headless; qt still needs a platform to create the widgets on
+    if arguments.test:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    application = QApplication(sys.argv[:1] + qt_arguments)
+    main_window = MainWindow(port_name=arguments.port)
+    if arguments.test:
+        # a fresh runner per script so timeouts and leftover data don't carry over
+        passed = all([ScriptRunner(main_window.terminal_widget).run(file_path) for file_path in arguments.test])
+        main_window.terminal_widget.serial_close()
+        main_window.code_widget.closeEvent(None)
+        sys.exit(0 if passed else 1)
+
     main_window.resize(1000,600)
     main_window.show()
     sys.exit(application.exec_())